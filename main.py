@@ -1,17 +1,22 @@
 import os
 import time
 import hmac
-import hashlib
-import base64
-import urllib.parse
-import requests
-import json
+import asyncio
+import functools
+import pybase64
+import httpx
+import ijson
+import orjson
 import re
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime, timedelta, timezone
 
 # 从环境变量获取配置
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
 SECRET = os.environ.get('SECRET')
+SECRET_ENC = SECRET.encode('utf-8') if SECRET else None
+# 待签名串里只有时间戳会变，"\n{SECRET}" 后缀预先编码好
+_SIGN_SUFFIX = b'\n' + SECRET_ENC if SECRET_ENC else None
 
 # --- 模块化内容生成系统 ---
 
@@ -57,21 +62,38 @@ def get_task_content(task):
 
 # --- 核心工具函数 ---
 
+# 匹配第一行 Markdown 标题（# 开头），C 级状态机单次扫描即停
+_TITLE_RE = re.compile(r'^[ \t]*#+[ \t]*(.+?)[ \t]*$', re.M)
+
+# 模板里的 {{xxx}} 占位符，一次扫描全部替换
+_PLACEHOLDER_RE = re.compile(r'\{\{(\w+)\}\}')
+
+def render_template(tpl, values):
+    """单遍替换模板中的 {{xxx}} 占位符，未知占位符原样保留"""
+    return _PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)), tpl)
+
 def derive_title(md_text):
     """从 Markdown 内容中提取标题"""
-    for line in md_text.splitlines():
-        s = line.strip()
-        if s.startswith('#'):
-            return s.lstrip('#').strip()
-    return '提醒通知'
+    m = _TITLE_RE.search(md_text)
+    return m.group(1) if m else '提醒通知'
+
+@functools.lru_cache(maxsize=2048)
+def _parse_minute(hm):
+    """把 "HH:MM" 解析成当天第几分钟，相同时间串跨任务/跨轮次复用"""
+    hh, mm = map(int, hm.split(':'))
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        raise ValueError(hm)
+    return hh * 60 + mm
+
+BEIJING_TZ = timezone(timedelta(hours=8))
 
 def get_beijing_time():
     """获取北京时间 (UTC+8)"""
-    return datetime.utcnow() + timedelta(hours=8)
+    return datetime.now(BEIJING_TZ)
 
-def format_message(title, content):
+def format_message(title, content, now=None):
     """默认消息模板"""
-    now = get_beijing_time().strftime('%Y-%m-%d %H:%M:%S')
+    now = (now or get_beijing_time()).strftime('%Y-%m-%d %H:%M:%S')
     template = """### 📌 任务提醒：{title}
 
 ---
@@ -88,36 +110,66 @@ def format_message(title, content):
 """
     return template.format(title=title, datetime=now, content=content)
 
+# tasks.json 超过该字节数时改用 ijson 流式解析
+_STREAM_THRESHOLD = 10_000_000
+
+def _strip_comments(buf):
+    """移除 tasks.json 中 JSON5 风格的 /* ... */ 注释
+
+    bytes.find 底层是 memchr/SIMD 查找，对大文件比正则扫描快得多。
+    """
+    out = bytearray()
+    i = 0
+    while True:
+        start = buf.find(b'/*', i)
+        if start < 0:
+            out.extend(buf[i:])
+            return bytes(out)
+        out.extend(buf[i:start])
+        end = buf.find(b'*/', start + 2)
+        if end < 0:
+            # 注释未闭合，丢弃剩余内容，交给 JSON 解析器报错
+            return bytes(out)
+        i = end + 2
+
+# base64 字母表里只有 + / = 需要 URL 转义，查表替换即可，无需通用 quote
+_QUOTE_TBL = str.maketrans({'+': '%2B', '/': '%2F', '=': '%3D'})
+
+# 签名只随毫秒时间戳变化，同一毫秒内的连续发送直接复用缓存结果
+_url_cache = {}
+_url_cache_keys = deque(maxlen=2)
+
 def get_signed_url():
     """生成钉钉带签名的 Webhook URL"""
     if not SECRET or not WEBHOOK_URL:
         print("错误: 缺少 WEBHOOK_URL 或 SECRET 环境变量")
         return None
-        
+
     timestamp = str(round(time.time() * 1000))
-    secret_enc = SECRET.encode('utf-8')
-    string_to_sign = '{}\n{}'.format(timestamp, SECRET)
-    string_to_sign_enc = string_to_sign.encode('utf-8')
-    hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
-    sign = urllib.parse.quote_plus(base64.b64encode(hmac_code).decode('utf-8'))
-    
+    cached = _url_cache.get(timestamp)
+    if cached is not None:
+        return cached
+
+    hmac_code = hmac.digest(SECRET_ENC, timestamp.encode('ascii') + _SIGN_SUFFIX, 'sha256')
+    sign = pybase64.b64encode(hmac_code).decode('ascii').translate(_QUOTE_TBL)
+
     if '?' in WEBHOOK_URL:
-        return f"{WEBHOOK_URL}&timestamp={timestamp}&sign={sign}"
-    return f"{WEBHOOK_URL}?timestamp={timestamp}&sign={sign}"
+        url = f"{WEBHOOK_URL}&timestamp={timestamp}&sign={sign}"
+    else:
+        url = f"{WEBHOOK_URL}?timestamp={timestamp}&sign={sign}"
 
-def send_markdown_msg(markdown_text, at_mobiles=[], at_user_ids=[], is_at_all=False):
-    """发送 Markdown 消息"""
-    url = get_signed_url()
-    if not url:
-        return
+    if len(_url_cache_keys) == _url_cache_keys.maxlen:
+        _url_cache.pop(_url_cache_keys[0], None)
+    _url_cache_keys.append(timestamp)
+    _url_cache[timestamp] = url
+    return url
 
-    headers = {"Content-Type": "application/json"}
-    title = derive_title(markdown_text)
-    
-    data = {
+def build_markdown_payload(markdown_text, at_mobiles=[], at_user_ids=[], is_at_all=False):
+    """构造 Markdown 消息体"""
+    return {
         "msgtype": "markdown",
         "markdown": {
-            "title": title,
+            "title": derive_title(markdown_text),
             "text": markdown_text
         },
         "at": {
@@ -126,78 +178,114 @@ def send_markdown_msg(markdown_text, at_mobiles=[], at_user_ids=[], is_at_all=Fa
             "atMobiles": at_mobiles
         }
     }
-    
-    try:
-        res = requests.post(url, json=data, headers=headers)
-        print(f"发送响应: {res.text}")
-    except Exception as e:
-        print(f"发送失败: {e}")
+
+async def _post_all(url, payloads):
+    """在一个 HTTP/2 连接上并发 POST 所有消息"""
+    headers = {"Content-Type": "application/json"}
+    # http2 须在 transport 上开启：显式传 transport 时客户端级的 http2 参数会被忽略
+    transport = httpx.AsyncHTTPTransport(retries=2, http2=True)
+    async with httpx.AsyncClient(timeout=5, transport=transport) as client:
+        return await asyncio.gather(
+            *(client.post(url, content=orjson.dumps(p), headers=headers) for p in payloads),
+            return_exceptions=True,
+        )
+
+def send_markdown_msgs(payloads):
+    """批量发送 Markdown 消息，多条消息并发出站，总耗时约一个往返"""
+    url = get_signed_url()
+    if not url or not payloads:
+        return
+
+    for res in asyncio.run(_post_all(url, payloads)):
+        if isinstance(res, Exception):
+            print(f"发送失败: {res}")
+        else:
+            print(f"发送响应: {res.text}")
 
 # --- 调度逻辑 ---
 
 def run_scheduler():
+    # 时间只取一次，各种格式串也只格式化一次
     now = get_beijing_time()
     today_str = now.strftime('%Y-%m-%d')
     current_hm = now.strftime('%H:%M')
-    
+    now_full = now.strftime('%Y-%m-%d %H:%M:%S')
+
     print(f"当前系统时间(北京时间): {today_str} {current_hm}")
 
     # 读取任务
     try:
-        with open('tasks.json', 'r', encoding='utf-8') as f:
-            # 移除注释支持 JSON5 风格
-            text = f.read()
-            text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
-            tasks = json.loads(text)
+        if os.path.getsize('tasks.json') > _STREAM_THRESHOLD:
+            # 流式解析：逐条产出并当场按日期过滤，整个文件不驻留内存
+            # 此路径不剥离注释，超大任务文件须是纯 JSON
+            with open('tasks.json', 'rb') as f:
+                tasks = [t for t in ijson.items(f, 'item') if t.get('date') == today_str]
+        else:
+            with open('tasks.json', 'rb') as f:
+                # 移除注释支持 JSON5 风格
+                tasks = orjson.loads(_strip_comments(f.read()))
     except Exception as e:
         print(f"读取 tasks.json 失败: {e}")
         return
 
-    found_task = False
-    
+    # 按日期分桶，循环只走今天的任务，O(命中数) 而非 O(总任务数)
+    # 分桶时顺便把 "HH:MM" 解析成当天第几分钟，循环内只剩整数比较
+    by_date = {}
+    for t in tasks:
+        hm = t.get('time')
+        if hm:
+            try:
+                t['_task_minute'] = _parse_minute(hm)
+            except ValueError:
+                print(f"时间格式错误: {hm}，应为 HH:MM")
+                continue
+        by_date.setdefault(t.get('date'), []).append(t)
+
     # 设定时间匹配窗口（分钟）
     # 意味着：只要当前时间在 任务时间 的 15分钟后以内，就视为匹配
     # 配合 GitHub Actions 的 cron 设置（例如每15分钟运行一次），可以确保任务不丢失
     TIME_WINDOW_MINUTES = 15
+    now_minute = now.hour * 60 + now.minute
 
-    for task in tasks:
-        # 1. 检查日期
-        if task.get('date') != today_str:
-            continue
-            
-        # 2. 检查时间（支持时间窗口匹配）
-        task_time_str = task.get('time')
-        if task_time_str:
-            try:
-                # 构造任务的完整 datetime 对象
-                task_dt = datetime.strptime(f"{today_str} {task_time_str}", "%Y-%m-%d %H:%M")
-                # 计算时间差：当前时间 - 任务时间
-                diff = now - task_dt
-                diff_minutes = diff.total_seconds() / 60
-                
-                # 逻辑：
-                # 如果 diff_minutes < 0: 任务在未来，还没到时间 -> 跳过
-                # 如果 0 <= diff_minutes <= 15: 任务刚刚过去 15 分钟内 -> 发送
-                # 如果 diff_minutes > 15: 任务已经过去很久了 -> 跳过 (避免重复发送旧任务)
-                
-                if diff_minutes < 0:
-                    # print(f"任务 {task_time_str} 尚未到时间 (还有 {abs(diff_minutes):.1f} 分钟)")
-                    continue
-                elif diff_minutes > TIME_WINDOW_MINUTES:
-                    # print(f"任务 {task_time_str} 已过期 (超过 {diff_minutes:.1f} 分钟)")
-                    continue
-                else:
-                    print(f">>> 命中时间窗口: 任务设定 {task_time_str}, 当前 {current_hm}, 偏差 {diff_minutes:.1f} 分钟")
-            except ValueError:
-                print(f"时间格式错误: {task_time_str}，应为 HH:MM")
+    # 先用纯整数比较过滤出命中的任务，字符串/模板工作只对命中者进行
+    # 逻辑：
+    # 如果 diff_minutes < 0: 任务在未来，还没到时间 -> 跳过
+    # 如果 0 <= diff_minutes <= 15: 任务刚刚过去 15 分钟内 -> 发送
+    # 如果 diff_minutes > 15: 任务已经过去很久了 -> 跳过 (避免重复发送旧任务)
+    matched = []
+    for task in by_date.get(today_str, ()):
+        task_minute = task.get('_task_minute')
+        if task_minute is not None:
+            diff_minutes = now_minute - task_minute
+            if not 0 <= diff_minutes <= TIME_WINDOW_MINUTES:
                 continue
+            print(f">>> 命中时间窗口: 任务设定 {task['time']}, 当前 {current_hm}, 偏差 {diff_minutes} 分钟")
+        matched.append(task)
+
+    # 没有命中就直接收工，模板读取和消息生成一概不做
+    if not matched:
+        print("本次运行未匹配到待发送任务。")
+        return
 
-        # 3. 生成内容
+    # 模板整轮只读一次，循环内只做占位符替换
+    # 直接 open 而非先 exists 再 open：少一次 stat，也没有 TOCTOU 窗口
+    tpl = None
+    try:
+        with open('template.md', 'r', encoding='utf-8') as f:
+            tpl = f.read()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"读取 template.md 出错: {e}, 使用默认格式")
+
+    outbox = []
+    for task in matched:
+        # 生成内容
         print(f"准备发送任务: {task.get('content', '动态内容')[:20]}...")
         final_content = get_task_content(task)
         title = task.get('title', '日程提醒')
 
-        # 4. 处理 @提及
+        # 处理 @提及
         at_mobiles = task.get('at_mobiles', [])
         is_at_all = task.get('is_at_all', False)
         if is_at_all:
@@ -207,34 +295,30 @@ def run_scheduler():
         else:
             mentions_text = "无"
 
-        # 5. 渲染模板
-        if os.path.exists('template.md'):
+        # 渲染模板
+        if tpl is not None:
             try:
-                with open('template.md', 'r', encoding='utf-8') as f:
-                    tpl = f.read()
-                md_text = (
-                    tpl.replace('{{title}}', title)
-                       .replace('{{datetime}}', now.strftime('%Y-%m-%d %H:%M:%S'))
-                       .replace('{{content}}', final_content)
-                       .replace('{{mentions}}', mentions_text)
-                )
+                md_text = render_template(tpl, {
+                    'title': title,
+                    'datetime': now_full,
+                    'content': final_content,
+                    'mentions': mentions_text,
+                })
             except Exception as e:
                 print(f"模板渲染出错: {e}, 使用默认格式")
-                md_text = format_message(title, final_content)
+                md_text = format_message(title, final_content, now)
         else:
-            md_text = format_message(title, final_content)
+            md_text = format_message(title, final_content, now)
         
-        # 6. 发送
-        send_markdown_msg(
+        outbox.append(build_markdown_payload(
             markdown_text=md_text,
             at_mobiles=at_mobiles,
             at_user_ids=task.get('at_user_ids', []),
             is_at_all=is_at_all
-        )
-        found_task = True
-    
-    if not found_task:
-        print("本次运行未匹配到待发送任务。")
+        ))
+
+    # 统一并发发送
+    send_markdown_msgs(outbox)
 
 if __name__ == "__main__":
     run_scheduler()